@@ -1,82 +1,133 @@
+import io
+
+import numpy as np
 import pandas as pd
 import streamlit as st
 from datetime import datetime
 
-def allocate_stock_recursive(customers, logic_stock):
+try:
+    from numba import njit
+except ImportError:  # numba が無い環境では通常の Python 関数として実行する
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
+# 数値列の計算では DataFrame.apply(..., axis=1) を使わないこと。
+# 行ごとに Series を作って Python を呼び直すため非常に遅い。
+# 代わりに列どうしのベクトル演算、0除算は np.where(分母 != 0, 分子 / 分母, 0)、
+# 複雑な処理は .to_numpy() した配列を受け取る @njit 関数で書く。
+
+
+@njit(cache=True, fastmath=True)
+def _allocate_kernel(ratio, demand, logic_stock):
     """
     【ロジック用在庫】に対して、
-    再帰的に「配分比率 × 在庫数」を割り当てる関数。
+    繰り返し「配分比率 × 在庫数」を割り当てる関数。
 
     Parameters
     ----------
-    customers: list of dict
-        [
-            {
-                "name": 得意先名,
-                "ratio": 配分比率 (0.0 ~ 1.0),
-                "demand": 希望数量(受注数量),
-            },
-            ...
-        ]
-    logic_stock: int
+    ratio: numpy.ndarray (float64)
+        得意先ごとの配分比率 (0.0 ~ 1.0)
+    demand: numpy.ndarray (float64)
+        得意先ごとの希望数量(受注数量)
+    logic_stock: float
         今回のロジックで配分する在庫数(裁量で除外した分を引いた後の在庫)
 
     Returns
     -------
-    customers: list of dict
-        "allocated" (float)キーで配分結果を保持。
-        最終的には round() で整数化済みの割当数が入る。
+    allocated: numpy.ndarray (float64)
+        得意先ごとの配分結果。np.rint() で整数に丸め済み。
     """
+    n = ratio.shape[0]
+    allocated = np.empty(n, dtype=np.float64)
 
     # 1) 初期割当: ratio * logic_stock を、その得意先の希望数量(demand)上限で割り当て
-    for c in customers:
-        init_alloc = c["ratio"] * logic_stock
-        c["allocated"] = min(init_alloc, c["demand"])
+    used = 0.0
+    for i in range(n):
+        allocated[i] = min(ratio[i] * logic_stock, demand[i])
+        used += allocated[i]
 
-    used = sum(c["allocated"] for c in customers)
     leftover = logic_stock - used
 
-    # 2) leftover を再帰的に配分する関数
-    def redistribute_recursive(customer_list, lf):
-        if lf <= 0:
-            return lf
-
+    # 2) leftover が無くなるか、配分先が無くなるまで繰り返し配分
+    while leftover > 0:
         # 需要が残っている得意先の ratio 合計を求める
         ratio_sum = 0.0
-        for cust in customer_list:
-            remain = cust["demand"] - cust["allocated"]
-            if remain > 0:
-                ratio_sum += cust["ratio"]
+        for i in range(n):
+            if demand[i] - allocated[i] > 0:
+                ratio_sum += ratio[i]
 
         if ratio_sum == 0:
-            return lf
+            break
 
+        # 再正規化した比率で leftover を配分
         allocated_this_round = 0.0
-        for cust in customer_list:
-            remain = cust["demand"] - cust["allocated"]
+        for i in range(n):
+            remain = demand[i] - allocated[i]
             if remain > 0:
-                # 再正規化した比率で leftover を配分
-                portion = lf * (cust["ratio"] / ratio_sum)
-                actual = min(portion, remain)
-                cust["allocated"] += actual
+                actual = min(leftover * (ratio[i] / ratio_sum), remain)
+                allocated[i] += actual
                 allocated_this_round += actual
 
-        lf -= allocated_this_round
-
-        # まだ leftover が残る場合は再帰
-        if lf > 0 and allocated_this_round > 0:
-            lf = redistribute_recursive(customer_list, lf)
+        leftover -= allocated_this_round
 
-        return lf
+        if allocated_this_round == 0:
+            break
 
-    # 3) 再帰的に leftover を配分
-    leftover = redistribute_recursive(customers, leftover)
+    # 3) 整数に丸める (ルールに応じて変更可能)
+    return np.rint(allocated)
 
-    # 4) 整数に丸める (ルールに応じて変更可能)
-    for c in customers:
-        c["allocated"] = round(c["allocated"])
 
-    return customers
+@st.cache_data
+def load_and_aggregate(file_bytes: bytes) -> pd.DataFrame:
+    """
+    アップロードされたCSVを読み込み、得意先ごとに集計する関数。
+    Streamlit の再実行のたびに読み込み・集計し直さないようキャッシュする。
+    """
+    # 集計に使う列だけを、型を指定して読み込む (型推論と不要列の読み込みを省く)
+    # 繰り返し現れるキー列は category 型にし、groupby を整数コードで行わせる
+    df = pd.read_csv(
+        io.BytesIO(file_bytes),
+        usecols=['得意先コード', '得意先名', '年月', '売上日付ユニーク数', '数量合計', '売上金額合計'],
+        dtype={
+            '得意先コード': 'category',
+            '得意先名': 'category',
+            '年月': 'category',
+            # 空欄や小数が含まれていても合計できるよう数値列は float64 で読む
+            '売上日付ユニーク数': 'float64',
+            '数量合計': 'float64',
+            '売上金額合計': 'float64',
+        }
+    )
+
+    # 集計処理
+    keys = ['得意先コード', '得意先名']
+    # 年月のユニーク数 (グループごとの nunique ではなく、全体の重複を一度で除いてから数える)
+    month_counts = (
+        df[keys + ['年月']].drop_duplicates()
+        .groupby(keys, sort=False, observed=True)['年月'].count()
+    )
+    sums = df.groupby(keys, sort=False, observed=True).agg({
+        '売上日付ユニーク数': 'sum',   # 売上日付ユニーク数の合計
+        '数量合計': 'sum',             # 数量合計
+        '売上金額合計': 'sum',         # 売上金額合計
+    })
+    grouped = pd.concat([month_counts, sums], axis=1).reset_index()
+    grouped.rename(columns={
+        '年月': '注文月数',
+        '売上日付ユニーク数': '注文回数',
+        '数量合計': '数量計',
+        '売上金額合計': '売上計'
+    }, inplace=True)
+
+    # 選択肢として使うため、集計後に残った得意先名だけをカテゴリに残す
+    grouped['得意先名'] = grouped['得意先名'].cat.remove_unused_categories()
+
+    # 得意先名で行を引けるようにインデックス化 (列としても残す)
+    grouped = grouped.set_index('得意先名', drop=False).rename_axis(None)
+
+    return grouped
 
 
 def main():
@@ -85,75 +136,42 @@ def main():
     # CSVファイルのアップロード
     uploaded_file = st.file_uploader("CSVファイルをアップロードしてください", type="csv")
     if uploaded_file:
-        # データ読み込み
-        df = pd.read_csv(uploaded_file)
-
-        # 集計処理
-        grouped = df.groupby(['得意先コード', '得意先名']).agg({
-            '年月': pd.Series.nunique,      # 年月のユニーク数
-            '売上日付ユニーク数': 'sum',   # 売上日付ユニーク数の合計
-            '数量合計': 'sum',             # 数量合計
-            '売上金額合計': 'sum',         # 売上金額合計
-        }).reset_index()
-        grouped.rename(columns={
-            '年月': '注文月数',
-            '売上日付ユニーク数': '注文回数',
-            '数量合計': '数量計',
-            '売上金額合計': '売上計'
-        }, inplace=True)
+        # データ読み込み・集計 (アップロード内容が同じならキャッシュを利用)
+        grouped = load_and_aggregate(uploaded_file.getvalue())
 
         # 売上金額合計でソート
         grouped = grouped.sort_values(by='売上計', ascending=False)
         st.write("集計結果:")
-        st.dataframe(grouped)
-
-        # 得意先名順にソート
-        grouped = grouped.sort_values(by='得意先名')
+        st.dataframe(grouped, hide_index=True)
 
         # ドロップダウンボックスで得意先を選択
         selected_clients = st.multiselect(
             "得意先を選択してください（得意先名順）:",
-            options=grouped['得意先名'].unique()
+            options=grouped['得意先名'].cat.categories
         )
         
         if selected_clients:
-            filtered_data = grouped[grouped['得意先名'].isin(selected_clients)]
+            filtered_data = grouped.loc[list(selected_clients)]
             st.write("選択された得意先のデータ:")
-            st.dataframe(filtered_data)
+            st.dataframe(filtered_data, hide_index=True)
 
             # セッションステートで発注数量を管理
-            if "order_quantities" not in st.session_state:
+            # (選択順に並んだ配列 order_values と、得意先名 → 位置 の対応表 order_index)
+            # order_quantities には選択を外した得意先も含めた入力済みの値を保持する
+            if "order_index" not in st.session_state:
                 st.session_state.order_quantities = {}
+                st.session_state.order_index = {}
+                st.session_state.order_values = np.zeros(0, dtype=np.int64)
 
-            # 得意先からの受注数量を入力
-            st.write("得意先からの受注数量を入力してください:")
-            for client in selected_clients:
-                col1, col2 = st.columns([3, 1])
-                with col1:
-                    st.write(client)
-                with col2:
-                    current_quantity = st.session_state.order_quantities.get(client, 0)
-                    st.session_state.order_quantities[client] = st.number_input(
-                        label="受注数量",
-                        min_value=0,
-                        step=1,
-                        value=current_quantity,
-                        key=f"order_quantity_{client}"
-                    )
-                    
-            # ループ後に合計を集計して表示
-            total_demand_input = sum(st.session_state.order_quantities[client] for client in selected_clients)
-            st.write(f"受注数量合計: **{total_demand_input}** 個")
-
-            # 商品の総数（入荷）
-            total_products = st.number_input("商品の入荷数を入力してください", min_value=0, step=1)
-
-            # 裁量比率を入力
-            discretion_ratio = st.number_input(
-                "裁量比率を入力してください (0 ~ 1の範囲)",
-                min_value=0.0, max_value=1.0,
-                step=0.1, value=0.3
-            )
+            # 選択が変わったときだけ作り直す (選択を外して戻した得意先の値も引き継ぐ)
+            if list(st.session_state.order_index) != list(selected_clients):
+                order_quantities = st.session_state.order_quantities
+                order_quantities.update(zip(st.session_state.order_index, st.session_state.order_values.tolist()))
+                st.session_state.order_values = np.array(
+                    [order_quantities.get(c, 0) for c in selected_clients],
+                    dtype=np.int64
+                )
+                st.session_state.order_index = {c: i for i, c in enumerate(selected_clients)}
 
             # セッションステートで各集計データの重みを管理
             if "weights" not in st.session_state:
@@ -195,82 +213,113 @@ def main():
                 elif number_value != st.session_state.weights[key]:
                     st.session_state.weights[key] = number_value
 
-            st.write("各集計データの重みを設定してください:")
-            sync_slider_and_input("取引年月の重み", "weight_1")
-            sync_slider_and_input("注文回数の重み", "weight_2")
-            sync_slider_and_input("数量合計の重み", "weight_3")
-            sync_slider_and_input("売上金額合計の重み", "weight_4")
-
-            # 配分計算ボタン
-            if st.button("配分計算"):
-                # 0除算回避用
-                def safe_div(x, y):
-                    return x / y if y != 0 else 0
-
-                # スコア計算
-                filtered_data['年月スコア'] = filtered_data.apply(
-                    lambda r: safe_div(r['注文月数'], filtered_data['注文月数'].sum()) * st.session_state.weights["weight_1"],
-                    axis=1
-                )
-                filtered_data['注文回数スコア'] = filtered_data.apply(
-                    lambda r: safe_div(r['注文回数'], filtered_data['注文回数'].sum()) * st.session_state.weights["weight_2"],
-                    axis=1
-                )
-                filtered_data['数量スコア'] = filtered_data.apply(
-                    lambda r: safe_div(r['数量計'], filtered_data['数量計'].sum()) * st.session_state.weights["weight_3"],
-                    axis=1
-                )
-                filtered_data['売上金額スコア'] = filtered_data.apply(
-                    lambda r: safe_div(r['売上計'], filtered_data['売上計'].sum()) * st.session_state.weights["weight_4"],
-                    axis=1
+            # 入力中の再実行を避けるため、入力欄はフォームにまとめて送信時に一度だけ反映する
+            with st.form("config"):
+                # 得意先からの受注数量を入力
+                # (セッションステートの参照とウィジェットキーの生成はループの外で一度だけ行う)
+                st.write("得意先からの受注数量を入力してください:")
+                order_values = st.session_state.order_values
+                keys = [f"order_quantity_{client}" for client in selected_clients]
+                for i, (client, key) in enumerate(zip(selected_clients, keys)):
+                    col1, col2 = st.columns([3, 1])
+                    with col1:
+                        st.write(client)
+                    with col2:
+                        order_values[i] = st.number_input(
+                            label="受注数量",
+                            min_value=0,
+                            step=1,
+                            value=int(order_values[i]),
+                            key=key
+                        )
+                    
+                # ループ後に合計を集計して表示
+                total_demand_input = int(order_values.sum())
+                st.write(f"受注数量合計: **{total_demand_input}** 個")
+
+                # 商品の総数（入荷）
+                total_products = st.number_input("商品の入荷数を入力してください", min_value=0, step=1)
+
+                # 裁量比率を入力
+                discretion_ratio = st.number_input(
+                    "裁量比率を入力してください (0 ~ 1の範囲)",
+                    min_value=0.0, max_value=1.0,
+                    step=0.1, value=0.3
                 )
 
-                # 総合スコア
-                filtered_data['スコア'] = (
-                    filtered_data['年月スコア'] +
-                    filtered_data['注文回数スコア'] +
-                    filtered_data['数量スコア'] +
-                    filtered_data['売上金額スコア']
+                st.write("各集計データの重みを設定してください:")
+                sync_slider_and_input("取引年月の重み", "weight_1")
+                sync_slider_and_input("注文回数の重み", "weight_2")
+                sync_slider_and_input("数量合計の重み", "weight_3")
+                sync_slider_and_input("売上金額合計の重み", "weight_4")
+
+                # 配分計算ボタン
+                submitted = st.form_submit_button("配分計算")
+
+            if submitted:
+                weights = st.session_state.weights
+
+                # スコア計算用に、必要な列だけを持つ小さな DataFrame を作る
+                scoring = pd.DataFrame({
+                    '名': filtered_data['得意先名'].to_numpy(),
+                    '月': filtered_data['注文月数'].to_numpy(dtype=np.float64),
+                    '回': filtered_data['注文回数'].to_numpy(dtype=np.float64),
+                    '量': filtered_data['数量計'].to_numpy(dtype=np.float64),
+                    '額': filtered_data['売上計'].to_numpy(dtype=np.float64),
+                })
+
+                # 各列の合計は一度だけ計算し、以降の計算で使い回す
+                s_month, s_orders, s_qty, s_amount = scoring[['月', '回', '量', '額']].sum()
+
+                # 重み / 列合計 の係数 (合計が0なら0とする)
+                c1 = weights["weight_1"] / s_month if s_month else 0.0
+                c2 = weights["weight_2"] / s_orders if s_orders else 0.0
+                c3 = weights["weight_3"] / s_qty if s_qty else 0.0
+                c4 = weights["weight_4"] / s_amount if s_amount else 0.0
+
+                # 総合スコア (中間のスコア列は作らず、配列演算一回で合算する)
+                score = (
+                    scoring['月'].to_numpy() * c1 +
+                    scoring['回'].to_numpy() * c2 +
+                    scoring['量'].to_numpy() * c3 +
+                    scoring['額'].to_numpy() * c4
                 )
 
-                total_score = filtered_data['スコア'].sum()
+                # 配分比率は filtered_data の列にせず配列のまま渡す
+                total_score = score.sum()
                 if total_score > 0:
-                    filtered_data['配分比率'] = filtered_data['スコア'] / total_score
+                    ratios = score / total_score
                 else:
-                    filtered_data['配分比率'] = 0
+                    ratios = np.zeros_like(score)
 
                 # 受注数量を取得
-                order_quantities = st.session_state.order_quantities
-                filtered_data['受注数量'] = filtered_data['得意先名'].map(order_quantities)
+                # filtered_data は selected_clients の順に並ぶため、得意先名の重複が無ければ
+                # order_values がそのまま対応する。重複がある場合のみ位置を引いて集める。
+                names = scoring['名'].to_numpy()
+                order_values = st.session_state.order_values
+                if len(names) == len(order_values):
+                    demands = order_values.astype(np.float64)
+                else:
+                    order_index = st.session_state.order_index
+                    positions = np.fromiter((order_index[n] for n in names), dtype=np.intp, count=len(names))
+                    demands = np.take(order_values, positions).astype(np.float64)
 
                 # 裁量分・ロジック分の在庫計算
                 # 例: total_products=100, discretion_ratio=0.3 => 裁量30、ロジック70
                 discretion_stock = round(total_products * discretion_ratio)
                 logic_stock = total_products - discretion_stock
 
-                # 再帰配分用のリストに格納
-                customers = []
-                for i, row in filtered_data.iterrows():
-                    customers.append({
-                        "name": row['得意先名'],
-                        "ratio": row['配分比率'],
-                        "demand": row['受注数量'] if row['受注数量'] is not None else 0,
-                        "allocated": 0.0
-                    })
-
-                # ロジック在庫を再帰的に配分
-                result_customers = allocate_stock_recursive(customers, logic_stock)
-
-                # 結果をDataFrame化
-                allocation_df = pd.DataFrame(result_customers)
-                allocation_df.rename(columns={
-                    "name": "得意先名",
-                    "ratio": "配分比率",
-                    "demand": "受注数量",
-                    "allocated": "配分結果"
-                }, inplace=True)
-
-                allocation_df = allocation_df.sort_values(by='配分比率', ascending=False)
+                # ロジック在庫を配分
+                allocated = _allocate_kernel(ratios, demands, float(logic_stock))
+
+                # 結果をDataFrame化 (配列から直接組み立てる)
+                allocation_df = pd.DataFrame({
+                    '得意先名': names,
+                    '配分比率': ratios,
+                    '受注数量': demands.astype(np.int64),
+                    '配分結果': allocated.astype(np.int64),
+                })
+                allocation_df.sort_values('配分比率', ascending=False, inplace=True, ignore_index=True)
                 # st.write("配分結果:")
                 # st.dataframe(allocation_df)
 